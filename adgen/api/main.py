@@ -1,12 +1,14 @@
 # adgen/api/main.py
 import os
+import json
 import time
 import shutil
 from pathlib import Path
+from typing import Literal
 
-from fastapi import FastAPI, HTTPException, status
+from fastapi import FastAPI, HTTPException, Query, status
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import FileResponse
+from fastapi.responses import FileResponse, Response
 from pydantic import BaseModel
 
 # Optional on Windows (fcntl is POSIX-only)
@@ -20,9 +22,11 @@ from orchestrator import (
     kickoff_generation,
     list_runs,
     get_run_detail,
+    get_run_timeline,
     cancel_run,
     finalize_run,
     _update_run_status,
+    upload_cache_stats,
 )
 
 app = FastAPI(title="AdGen API", version="0.1.0")
@@ -163,6 +167,12 @@ def detailed_health():
     return status_obj
 
 
+@app.get("/metrics/uploads")
+def upload_metrics():
+    """Reference-image upload dedupe counters (per API process)"""
+    return upload_cache_stats()
+
+
 @app.post("/generate")
 def generate(body: GenerateBody):
     try:
@@ -209,6 +219,28 @@ async def get_run_detail_endpoint(run_id: str):
         raise HTTPException(status_code=500, detail=str(e))
 
 
+@app.get("/runs/{run_id}/timeline")
+async def get_run_timeline_endpoint(run_id: str, fmt: Literal["json", "jsonl"] = Query("json", alias="format")):
+    """Return per-stage timing spans for a run (format=jsonl for a trace file)"""
+    try:
+        timeline = get_run_timeline(run_id)
+        if timeline is None:
+            raise HTTPException(status_code=404, detail="Run not found")
+        if fmt == "jsonl":
+            lines = [json.dumps({"run_id": timeline["run_id"], **sp}) for sp in timeline["spans"]]
+            return Response(
+                content="".join(line + "\n" for line in lines),
+                media_type="application/x-ndjson",
+                headers={"Content-Disposition": f'attachment; filename="{run_id}.timeline.jsonl"'},
+            )
+        return timeline
+    except HTTPException:
+        raise
+    except Exception as e:
+        print(f"[/runs/{run_id}/timeline] ERROR: {repr(e)}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+
 @app.post("/runs/{run_id}/cancel")
 async def cancel_run_endpoint(run_id: str):
     """Cancel a running generation"""
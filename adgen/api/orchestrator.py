@@ -1,8 +1,9 @@
 # orchestrator.py — env-driven ComfyUI orchestrator
 from __future__ import annotations
-import os, uuid, json, time, shutil
-from typing import Dict, List, Any
+import os, uuid, json, time, shutil, hashlib, mimetypes, threading
+from typing import Dict, List, Any, Tuple
 from pathlib import Path
+from contextlib import contextmanager
 import httpx
 import fcntl
 from unittest.mock import MagicMock
@@ -16,6 +17,14 @@ RUNS_DIR  = os.getenv("RUNS_DIR", "/app/adgen/runs")
 GRAPH_PATH = os.getenv("GRAPH_PATH", "/app/adgen/graphs/qwen.json")
 POLL_INTERVAL = float(os.getenv("POLL_INTERVAL", "0.8"))
 POLL_TIMEOUT  = float(os.getenv("POLL_TIMEOUT", "180"))
+ASSETS_DIR = os.getenv("ASSETS_DIR", "/app/adgen/assets")
+HASH_CHUNK = 1 << 20
+TIMELINE_EXPORT_DIR = os.getenv("TIMELINE_EXPORT_DIR", "")
+
+# Reference images already pushed to ComfyUI, keyed by (backend, sha256) -> uploaded name
+_UPLOAD_CACHE: Dict[Tuple[str, str], str] = {}
+_UPLOAD_STATS = {"hits": 0, "misses": 0}
+_UPLOAD_LOCK = threading.Lock()
 
 Path(RUNS_DIR).mkdir(parents=True, exist_ok=True)
 if not Path(GRAPH_PATH).exists():
@@ -63,12 +72,105 @@ def _coerce_run_id(v) -> str:
         v = cand
     return str(v or uuid.uuid4().hex[:12])
 
+# --- Timeline helpers ---
+class _Timeline:
+    """Collects per-stage spans for one phase of a run and stores them in meta.json["timeline"].
+
+    Durations come from the monotonic perf_counter; "start" is wall-clock epoch
+    seconds so spans recorded by /generate and /finalize line up. The first
+    flush replaces spans left by an earlier call of the same phase, so a
+    repeated /finalize doesn't double-count.
+    """
+
+    def __init__(self, run_id: str, phase: str):
+        self.run_id = run_id
+        self.phase = phase
+        self.spans: List[Dict[str, Any]] = []
+        self._replace = True
+
+    def add(self, stage: str, start: float, duration_ms: float, **attrs: Any) -> None:
+        attrs.setdefault("phase", self.phase)
+        self.spans.append({"stage": stage, "start": round(start, 6), "duration_ms": round(duration_ms, 3), **attrs})
+
+    @contextmanager
+    def span(self, stage: str, **attrs: Any):
+        start, t0 = time.time(), time.perf_counter()
+        try:
+            yield attrs
+        except Exception as e:
+            attrs["error"] = repr(e)
+            raise
+        finally:
+            self.add(stage, start, (time.perf_counter() - t0) * 1000, **attrs)
+
+    def flush(self) -> List[Dict[str, Any]]:
+        """Persists pending spans and returns the run's full timeline."""
+        spans, self.spans = self.spans, []
+        meta_path = os.path.join(_run_dir(self.run_id), "meta.json")
+        timeline: List[Dict[str, Any]] = spans
+        try:
+            with open(meta_path, "r+", encoding="utf-8") as f:
+                meta = json.load(f)
+                existing = meta.get("timeline") or []
+                if self._replace:
+                    existing = [sp for sp in existing if sp.get("phase") != self.phase]
+                timeline = existing + spans
+                meta["timeline"] = timeline
+                f.seek(0)
+                json.dump(meta, f, indent=2)
+                f.truncate()
+        except (FileNotFoundError, json.JSONDecodeError) as e:
+            print(f"Error writing timeline for {self.run_id}: {e}")
+        self._replace = False
+        if TIMELINE_EXPORT_DIR and spans:
+            try:
+                _ensure_dir(TIMELINE_EXPORT_DIR)
+                # Rewritten whole so it always mirrors meta.json
+                with open(os.path.join(TIMELINE_EXPORT_DIR, f"{self.run_id}.jsonl"), "w", encoding="utf-8") as f:
+                    for sp in timeline:
+                        f.write(json.dumps({"run_id": self.run_id, **sp}) + "\n")
+            except OSError as e:
+                print(f"Error exporting timeline for {self.run_id}: {e}")
+        return timeline
+
+def _timeline_elapsed_ms(spans: List[Dict[str, Any]]) -> float | None:
+    if not spans:
+        return None
+    start = min(sp["start"] for sp in spans)
+    end = max(sp["start"] + sp["duration_ms"] / 1000 for sp in spans)
+    return round((end - start) * 1000, 3)
+
+def _span_end(spans: List[Dict[str, Any]], stage: str) -> float | None:
+    for sp in reversed(spans):
+        if sp.get("stage") == stage:
+            return sp["start"] + sp["duration_ms"] / 1000
+    return None
+
+def _comfy_exec_window(hist: Dict[str, Any], prompt_id: str) -> Tuple[float, float] | None:
+    """Returns ComfyUI's (execution_start, execution_end) epoch seconds from /history, if reported."""
+    entry = hist.get(prompt_id, hist)
+    msgs = ((entry.get("status") or {}).get("messages") or []) if isinstance(entry, dict) else []
+    ts: Dict[str, float] = {}
+    for msg in msgs:
+        if isinstance(msg, list) and len(msg) == 2 and isinstance(msg[1], dict) and "timestamp" in msg[1]:
+            ts[msg[0]] = msg[1]["timestamp"] / 1000
+    end = ts.get("execution_success") or ts.get("execution_error") or ts.get("execution_interrupted")
+    if "execution_start" in ts and end:
+        return ts["execution_start"], end
+    return None
+
 # --- Graph helpers ---
 def _load_graph() -> Dict[str, Any]:
     with open(GRAPH_PATH, "r", encoding="utf-8") as f:
         return json.load(f)
 
-def _patch_graph_for_run(graph: Dict[str, Any], *, run_id: str, prompt: str, negative: str | None = None) -> Dict[str, Any]:
+def _patch_graph_for_run(
+    graph: Dict[str, Any],
+    *,
+    run_id: str,
+    prompt: str,
+    negative: str | None = None,
+) -> Dict[str, Any]:
     # Set prompt text on CLIPTextEncode nodes
     for node in graph.values():
         if node.get("class_type") == "CLIPTextEncode":
@@ -85,6 +187,128 @@ def _patch_graph_for_run(graph: Dict[str, Any], *, run_id: str, prompt: str, neg
             node["inputs"]["filename_prefix"] = run_id
     return graph
 
+# --- Reference image helpers ---
+REF_ROLES = ("logo", "mood")
+
+def _load_image_role(node: Dict[str, Any]) -> str | None:
+    """Returns the reference role ("logo"/"mood") a LoadImage node is titled for, if any."""
+    if node.get("class_type") != "LoadImage":
+        return None
+    title = (node.get("_meta", {}).get("title", "") or "").lower()
+    return next((role for role in REF_ROLES if role in title), None)
+
+def _wire_reference_images(graph: Dict[str, Any], ref_images: Dict[str, List[str]]) -> Dict[str, Any]:
+    # Point LoadImage nodes titled "logo"/"mood" at the uploaded reference images
+    pending = {role: list(names) for role, names in ref_images.items()}
+    for node in graph.values():
+        role = _load_image_role(node)
+        if role and pending.get(role):
+            node.setdefault("inputs", {})["image"] = pending[role].pop(0)
+    return graph
+
+def _reference_paths(payload: Dict[str, Any]) -> Dict[str, List[str]]:
+    """Collects logo/mood-board paths from a /generate body."""
+    refs: Dict[str, List[str]] = {role: [] for role in REF_ROLES}
+    for role in REF_ROLES:
+        p = payload.get(f"{role}_image")
+        if not p:
+            continue
+        if p.lower().startswith(("http://", "https://")):
+            # The web UI sends URLs here; only files under ASSETS_DIR are uploaded
+            print(f"[orchestrator] skipping {role} reference URL {p}")
+            continue
+        refs[role].append(p)
+    return refs
+
+def _resolve_asset(path: str) -> Path:
+    root = Path(ASSETS_DIR).resolve()
+    rel = Path(path)
+    # Accept both "logos/x.png" and recipe-style "assets/logos/x.png"
+    if rel.parts[:1] == ("assets",):
+        rel = Path(*rel.parts[1:])
+    p = (root / rel).resolve()
+    if rel.is_absolute() or not p.is_relative_to(root):
+        raise ValueError(f"Reference image must be inside ASSETS_DIR: {path}")
+    if not p.is_file():
+        raise FileNotFoundError(f"Reference image not found: {path}")
+    return p
+
+def _file_sha256(path: Path) -> str:
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+def _comfy_has_input(client: httpx.Client, name: str) -> bool:
+    """Checks that a previously uploaded input still exists (ComfyUI may have been wiped/recreated)."""
+    subfolder, _, filename = name.rpartition("/")
+    try:
+        r = client.head("/view", params={"filename": filename, "subfolder": subfolder, "type": "input"})
+    except httpx.HTTPError:
+        return False
+    return r.status_code == 200
+
+def _upload_image(client: httpx.Client, path: Path) -> str:
+    """Uploads an image to ComfyUI once per backend and returns the name LoadImage expects."""
+    digest = _file_sha256(path)
+    key = (COMFY_API, digest)
+    with _UPLOAD_LOCK:
+        cached = _UPLOAD_CACHE.get(key)
+    if cached and _comfy_has_input(client, cached):
+        with _UPLOAD_LOCK:
+            _UPLOAD_STATS["hits"] += 1
+        return cached
+
+    # Content-addressed name so re-uploads after a restart overwrite the same file
+    name = f"adgen_{digest[:16]}{path.suffix.lower()}"
+    mime = mimetypes.guess_type(path.name)[0] or "application/octet-stream"
+    with open(path, "rb") as f:
+        # httpx streams file objects in multipart bodies instead of reading them whole
+        r = client.post(
+            "/upload/image",
+            files={"image": (name, f, mime)},
+            data={"type": "input", "overwrite": "true"},
+        )
+    r.raise_for_status()
+    body = r.json() or {}
+    uploaded = body.get("name") or name
+    if body.get("subfolder"):
+        uploaded = f"{body['subfolder']}/{uploaded}"
+
+    with _UPLOAD_LOCK:
+        _UPLOAD_CACHE[key] = uploaded
+        _UPLOAD_STATS["misses"] += 1
+    print(f"[orchestrator] uploaded {path.name} -> {uploaded}")
+    return uploaded
+
+def _upload_references(client: httpx.Client, payload: Dict[str, Any], graph: Dict[str, Any]) -> Dict[str, List[str]]:
+    """Uploads only the references the graph has LoadImage slots for."""
+    slots = {role: 0 for role in REF_ROLES}
+    for node in graph.values():
+        role = _load_image_role(node)
+        if role:
+            slots[role] += 1
+    uploaded: Dict[str, List[str]] = {}
+    for role, paths in _reference_paths(payload).items():
+        if len(paths) > slots[role]:
+            print(f"[orchestrator] graph has no LoadImage slot for {role} reference(s) {paths[slots[role]:]}; ignoring")
+        uploaded[role] = [_upload_image(client, _resolve_asset(p)) for p in paths[:slots[role]]]
+    return uploaded
+
+def upload_cache_stats() -> Dict[str, Any]:
+    """Returns reference-image upload dedupe counters for this process."""
+    with _UPLOAD_LOCK:
+        hits, misses = _UPLOAD_STATS["hits"], _UPLOAD_STATS["misses"]
+        cached = len(_UPLOAD_CACHE)
+    total = hits + misses
+    return {
+        "hits": hits,
+        "misses": misses,
+        "hit_rate": round(hits / total, 4) if total else None,
+        "cached": cached,
+    }
+
 # --- Comfy helpers ---
 def _submit_prompt(client: httpx.Client, graph: Dict[str, Any], client_id: str) -> str:
     r = client.post("/prompt", json={"prompt": graph, "client_id": client_id})
@@ -149,15 +373,23 @@ def kickoff_generation(run_id: str, payload: Dict | None = None) -> Dict:
     negative = payload.get("negative_prompt")
     seed = payload.get("seed")
 
-    graph = _load_graph()
-    graph = _patch_graph_for_run(graph, run_id=run_id, prompt=prompt, negative=negative)
-    if seed is not None:
-        for node in graph.values():
-            if node.get("class_type", "").lower().endswith("ksampler"):
-                node.setdefault("inputs", {})["seed"] = int(seed)
-
-    with _http() as client:
-        prompt_id = _submit_prompt(client, graph, client_id=run_id)
+    timeline = _Timeline(run_id, "kickoff")
+    try:
+        with _http() as client:
+            with timeline.span("graph_prep"):
+                graph = _load_graph()
+                graph = _patch_graph_for_run(graph, run_id=run_id, prompt=prompt, negative=negative)
+                if seed is not None:
+                    for node in graph.values():
+                        if node.get("class_type", "").lower().endswith("ksampler"):
+                            node.setdefault("inputs", {})["seed"] = int(seed)
+            with timeline.span("upload_refs"):
+                _wire_reference_images(graph, _upload_references(client, payload, graph))
+
+            with timeline.span("submit"):
+                prompt_id = _submit_prompt(client, graph, client_id=run_id)
+    finally:
+        timeline.flush()
 
     # Update meta.json with run info
     meta_path = os.path.join(_run_dir(run_id), "meta.json")
@@ -209,59 +441,82 @@ def finalize_run(run_id: str) -> Dict:
     except Exception:
         meta = {}
 
-    payload = meta.get("payload", {}) if isinstance(meta.get("payload"), dict) else {}
+    payload = meta.get("inputs", {}) if isinstance(meta.get("inputs"), dict) else {}
     prompt = payload.get("prompt") or "sprite soda on a rock on water surrounded by a valley"
     negative = payload.get("negative_prompt")
 
     images = []
-    with _http() as client:
-        prompt_id = meta.get("prompt_id")
-        if not prompt_id:
-            if TEST_MODE:
-                prompt_id = "test_prompt_123"
-            else:
-                graph = _load_graph()
-                graph = _patch_graph_for_run(graph, run_id=run_id, prompt=prompt, negative=negative)
-                prompt_id = _submit_prompt(client, graph, client_id=run_id)
-            meta["prompt_id"] = prompt_id
-            with open(meta_path, "wb") as f:
-                f.write(json.dumps(meta, indent=2).encode())
-
-        try:
-            if TEST_MODE:
-                # Create fake image for testing
-                test_image = {"filename": f"{run_id}_test.png", "subfolder": "", "type": "output", "url": f"/runs/{run_id}/files/{run_id}_test.png"}
-                out_path = os.path.join(_run_dir(run_id), test_image["filename"])
-                with open(out_path, "wb") as f:
-                    f.write(b"fake_image_data_for_testing")
-                images.append({**test_image, "saved_to": out_path})
-            else:
-                hist = _poll_history(client, prompt_id)
-                for im in _iter_images(hist):
-                    params = {"filename": im["filename"], "subfolder": im.get("subfolder",""), "type": im.get("type","output")}
-                    r = client.get("/view", params=params)
-                    r.raise_for_status()
-                    out_path = os.path.join(_run_dir(run_id), im["filename"])
+    timeline = _Timeline(run_id, "finalize")
+    try:
+        with _http() as client:
+            prompt_id = meta.get("prompt_id")
+            if not prompt_id:
+                if TEST_MODE:
+                    prompt_id = "test_prompt_123"
+                else:
+                    # Kickoff work done late; tagged so a repeated finalize keeps it
+                    with timeline.span("graph_prep", phase="kickoff"):
+                        graph = _load_graph()
+                        graph = _patch_graph_for_run(graph, run_id=run_id, prompt=prompt, negative=negative)
+                    with timeline.span("upload_refs", phase="kickoff"):
+                        _wire_reference_images(graph, _upload_references(client, payload, graph))
+                    with timeline.span("submit", phase="kickoff"):
+                        prompt_id = _submit_prompt(client, graph, client_id=run_id)
+                meta["prompt_id"] = prompt_id
+                with open(meta_path, "wb") as f:
+                    f.write(json.dumps(meta, indent=2).encode())
+
+            try:
+                if TEST_MODE:
+                    # Create fake image for testing
+                    test_image = {"filename": f"{run_id}_test.png", "subfolder": "", "type": "output", "url": f"/runs/{run_id}/files/{run_id}_test.png"}
+                    out_path = os.path.join(_run_dir(run_id), test_image["filename"])
                     with open(out_path, "wb") as f:
-                        f.write(r.content)
-                    images.append({**im, "saved_to": out_path, "url": f"/runs/{run_id}/files/{im['filename']}"})
+                        f.write(b"fake_image_data_for_testing")
+                    images.append({**test_image, "saved_to": out_path})
+                else:
+                    with timeline.span("poll"):
+                        hist = _poll_history(client, prompt_id)
+                    window = _comfy_exec_window(hist, prompt_id)
+                    if window:
+                        # ComfyUI reports wall-clock ms, so these two spans use its clock
+                        exec_start, exec_end = window
+                        submitted = _span_end(timeline.spans, "submit") or _span_end(meta.get("timeline") or [], "submit")
+                        if submitted and exec_start >= submitted:
+                            timeline.add("queue_wait", submitted, (exec_start - submitted) * 1000, source="comfy")
+                        timeline.add("execute", exec_start, (exec_end - exec_start) * 1000, source="comfy")
+                    for im in _iter_images(hist):
+                        params = {"filename": im["filename"], "subfolder": im.get("subfolder",""), "type": im.get("type","output")}
+                        with timeline.span("download", filename=im["filename"]) as attrs:
+                            r = client.get("/view", params=params)
+                            r.raise_for_status()
+                            out_path = os.path.join(_run_dir(run_id), im["filename"])
+                            with open(out_path, "wb") as f:
+                                f.write(r.content)
+                            attrs["bytes"] = len(r.content)
+                        images.append({**im, "saved_to": out_path, "url": f"/runs/{run_id}/files/{im['filename']}"})
+
+                status = "COMPLETED"
+            except Exception as e:
+                print(f"Error during finalization of {run_id}: {e}")
+                status = "FAILED"
+
+        # Update meta.json with final status
+        with open(meta_path, "r+", encoding="utf-8") as f:
+            meta = json.load(f)
+            meta["status"] = status
+            meta["finished_at"] = time.strftime("%Y-%m-%dT%H:%M:%S%z")
+            meta["artifacts"] = images
+            f.seek(0)
+            json.dump(meta, f, indent=2)
+            f.truncate()
 
-            status = "COMPLETED"
-        except Exception as e:
-            print(f"Error during finalization of {run_id}: {e}")
-            status = "FAILED"
-
-    # Update meta.json with final status
-    with open(meta_path, "r+", encoding="utf-8") as f:
-        meta = json.load(f)
-        meta["status"] = status
-        meta["finished_at"] = time.strftime("%Y-%m-%dT%H:%M:%S%z")
-        meta["artifacts"] = images
-        f.seek(0)
-        json.dump(meta, f, indent=2)
-        f.truncate()
-
-    zip_path = _zip_run(run_id)
+        # Flush first so the meta.json inside the zip carries every span but "archive"
+        timeline.flush()
+        with timeline.span("archive"):
+            zip_path = _zip_run(run_id)
+    finally:
+        meta["timeline"] = timeline.flush()
     print(f"[orchestrator] finalize_run -> zip={zip_path}")
     return meta
 
@@ -275,16 +530,24 @@ def list_runs() -> List[Dict]:
                 try:
                     with open(meta_path, "r", encoding="utf-8") as f:
                         meta = json.load(f)
+                        duration = None
+                        if meta.get("finished_at"):
+                            elapsed_ms = _timeline_elapsed_ms(meta.get("timeline") or [])
+                            if elapsed_ms is not None:
+                                duration = round(elapsed_ms / 1000, 3)
+                            else:
+                                # Runs recorded before timelines existed
+                                duration = (
+                                    int(time.mktime(time.strptime(meta["finished_at"], "%Y-%m-%dT%H:%M:%S%z"))) -
+                                    int(time.mktime(time.strptime(meta["created_at"], "%Y-%m-%dT%H:%M:%S%z")))
+                                )
                         runs.append({
                             "run_id": meta.get("run_id"),
                             "prompt": meta.get("inputs", {}).get("prompt"),
                             "status": meta.get("status"),
                             "created_at": meta.get("created_at"),
                             "finished_at": meta.get("finished_at"),
-                            "duration": (
-                                int(time.mktime(time.strptime(meta["finished_at"], "%Y-%m-%dT%H:%M:%S%z"))) -
-                                int(time.mktime(time.strptime(meta["created_at"], "%Y-%m-%dT%H:%M:%S%z")))
-                            ) if meta.get("finished_at") else None,
+                            "duration": duration,
                         })
                 except (json.JSONDecodeError, KeyError) as e:
                     print(f"Skipping corrupt meta.json for run {p.name}: {e}")
@@ -299,6 +562,23 @@ def get_run_detail(run_id: str) -> Dict | None:
             return json.load(f)
     return None
 
+def get_run_timeline(run_id: str) -> Dict | None:
+    """Returns the recorded stage spans for a run, ordered by start time."""
+    detail = get_run_detail(run_id)
+    if detail is None:
+        return None
+    spans = sorted(detail.get("timeline") or [], key=lambda sp: sp["start"])
+    by_stage: Dict[str, float] = {}
+    for sp in spans:
+        by_stage[sp["stage"]] = round(by_stage.get(sp["stage"], 0.0) + sp["duration_ms"], 3)
+    return {
+        "run_id": detail.get("run_id"),
+        "status": detail.get("status"),
+        "elapsed_ms": _timeline_elapsed_ms(spans),
+        "by_stage_ms": by_stage,
+        "spans": spans,
+    }
+
 def cancel_run(run_id: str) -> Dict:
     """Cancels a run by updating its status."""
     run_id = _coerce_run_id(run_id)
@@ -0,0 +1,28 @@
+import os
+import sys
+import tempfile
+from pathlib import Path
+
+import pytest
+
+# orchestrator is imported as a top-level module and reads its env at import time
+API_DIR = Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(API_DIR))
+sys.path.insert(0, str(API_DIR.parents[1]))
+os.environ.setdefault("GRAPH_PATH", str(API_DIR / "adgen" / "graphs" / "qwen.json"))
+os.environ.setdefault("RUNS_DIR", tempfile.mkdtemp(prefix="adgen-runs-"))
+
+import orchestrator  # noqa: E402
+
+
+@pytest.fixture
+def orch(tmp_path, monkeypatch):
+    """orchestrator with per-test runs/assets dirs and a fresh upload cache."""
+    monkeypatch.setattr(orchestrator, "RUNS_DIR", str(tmp_path / "runs"))
+    monkeypatch.setattr(orchestrator, "ASSETS_DIR", str(tmp_path / "assets"))
+    monkeypatch.setattr(orchestrator, "TEST_MODE", False)
+    monkeypatch.setattr(orchestrator, "_UPLOAD_CACHE", {})
+    monkeypatch.setattr(orchestrator, "_UPLOAD_STATS", {"hits": 0, "misses": 0})
+    (tmp_path / "runs").mkdir()
+    (tmp_path / "assets").mkdir()
+    return orchestrator
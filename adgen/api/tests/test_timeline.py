@@ -0,0 +1,177 @@
+import json
+import time
+import zipfile
+
+import httpx
+import pytest
+from fastapi.testclient import TestClient
+
+from adgen.api.main import app
+
+client = TestClient(app)
+
+
+def _comfy_client():
+    """ComfyUI stand-in that finishes the prompt immediately with one image."""
+    def handler(req: httpx.Request) -> httpx.Response:
+        if req.url.path == "/prompt":
+            return httpx.Response(200, json={"prompt_id": "p1"})
+        if req.url.path == "/history/p1":
+            now_ms = time.time() * 1000
+            return httpx.Response(200, json={"p1": {
+                "status": {"messages": [
+                    ["execution_start", {"prompt_id": "p1", "timestamp": now_ms + 10}],
+                    ["execution_success", {"prompt_id": "p1", "timestamp": now_ms + 60}],
+                ]},
+                "outputs": {"9": {"images": [{"filename": "out.png", "subfolder": "", "type": "output"}]}},
+            }})
+        if req.url.path == "/view":
+            return httpx.Response(200, content=b"image-bytes")
+        return httpx.Response(404)
+    return httpx.Client(transport=httpx.MockTransport(handler), base_url="http://comfy")
+
+
+def test_comfy_exec_window_keyed_by_prompt_id(orch):
+    hist = {"p1": {"status": {"messages": [
+        ["execution_start", {"timestamp": 1000}],
+        ["execution_cached", {"nodes": []}],
+        ["execution_success", {"timestamp": 4500}],
+    ]}}}
+    assert orch._comfy_exec_window(hist, "p1") == (1.0, 4.5)
+
+
+def test_comfy_exec_window_without_messages(orch):
+    assert orch._comfy_exec_window({"p1": {"outputs": {}}}, "p1") is None
+    assert orch._comfy_exec_window({"outputs": {}}, "p1") is None
+
+
+def test_spans_persist_across_kickoff_and_finalize(orch, monkeypatch):
+    monkeypatch.setattr(orch, "_http", _comfy_client)
+    run_id = orch.create_run({"prompt": "x"})["run_id"]
+    orch.kickoff_generation(run_id, {"prompt": "x"})
+    stages = [sp["stage"] for sp in orch.get_run_detail(run_id)["timeline"]]
+    assert stages == ["graph_prep", "upload_refs", "submit"]
+
+    meta = orch.finalize_run(run_id)
+    assert meta["status"] == "COMPLETED"
+    spans = orch.get_run_detail(run_id)["timeline"]
+    assert [sp["stage"] for sp in spans] == [
+        "graph_prep", "upload_refs", "submit", "poll", "queue_wait", "execute", "download", "archive",
+    ]
+    download = next(sp for sp in spans if sp["stage"] == "download")
+    assert download["filename"] == "out.png" and download["bytes"] == len(b"image-bytes")
+    assert all(sp["duration_ms"] >= 0 for sp in spans)
+
+
+def test_failed_archive_still_saves_timeline(orch, monkeypatch):
+    monkeypatch.setattr(orch, "_http", _comfy_client)
+    run_id = orch.create_run({"prompt": "x"})["run_id"]
+    orch.kickoff_generation(run_id, {"prompt": "x"})
+
+    def boom(_run_id):
+        raise OSError("disk full")
+    monkeypatch.setattr(orch, "_zip_run", boom)
+    with pytest.raises(OSError):
+        orch.finalize_run(run_id)
+    spans = orch.get_run_detail(run_id)["timeline"]
+    assert "download" in [sp["stage"] for sp in spans]
+    assert spans[-1]["stage"] == "archive" and "disk full" in spans[-1]["error"]
+
+
+def test_bad_export_dir_does_not_fail_run(orch, monkeypatch, tmp_path):
+    blocker = tmp_path / "not-a-dir"
+    blocker.write_text("")
+    monkeypatch.setattr(orch, "TIMELINE_EXPORT_DIR", str(blocker / "traces"))
+    monkeypatch.setattr(orch, "_http", _comfy_client)
+    run_id = orch.create_run({"prompt": "x"})["run_id"]
+    assert orch.kickoff_generation(run_id, {"prompt": "x"})["status"] == "RUNNING"
+    assert orch.finalize_run(run_id)["status"] == "COMPLETED"
+
+
+def test_export_dir_receives_jsonl(orch, monkeypatch, tmp_path):
+    monkeypatch.setattr(orch, "TIMELINE_EXPORT_DIR", str(tmp_path / "traces"))
+    monkeypatch.setattr(orch, "_http", _comfy_client)
+    run_id = orch.create_run({"prompt": "x"})["run_id"]
+    orch.kickoff_generation(run_id, {"prompt": "x"})
+    orch.finalize_run(run_id)
+    lines = (tmp_path / "traces" / f"{run_id}.jsonl").read_text().splitlines()
+    assert [json.loads(line)["stage"] for line in lines][-1] == "archive"
+
+
+def test_timeline_endpoint_json_and_jsonl(orch, monkeypatch):
+    monkeypatch.setattr(orch, "_http", _comfy_client)
+    run_id = orch.create_run({"prompt": "x"})["run_id"]
+    orch.kickoff_generation(run_id, {"prompt": "x"})
+    orch.finalize_run(run_id)
+
+    response = client.get(f"/runs/{run_id}/timeline")
+    assert response.status_code == 200
+    body = response.json()
+    assert body["run_id"] == run_id and body["status"] == "COMPLETED"
+    assert set(body["by_stage_ms"]) >= {"submit", "poll", "download", "archive"}
+    assert body["elapsed_ms"] >= 0
+
+    response = client.get(f"/runs/{run_id}/timeline", params={"format": "jsonl"})
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("application/x-ndjson")
+    rows = [json.loads(line) for line in response.text.splitlines()]
+    assert [r["stage"] for r in rows] == [sp["stage"] for sp in body["spans"]]
+    assert all(r["run_id"] == run_id for r in rows)
+
+
+def test_repeated_finalize_replaces_finalize_spans(orch, monkeypatch, tmp_path):
+    monkeypatch.setattr(orch, "TIMELINE_EXPORT_DIR", str(tmp_path / "traces"))
+    monkeypatch.setattr(orch, "_http", _comfy_client)
+    run_id = orch.create_run({"prompt": "x"})["run_id"]
+    orch.kickoff_generation(run_id, {"prompt": "x"})
+    orch.finalize_run(run_id)
+    orch.finalize_run(run_id)
+
+    stages = [sp["stage"] for sp in orch.get_run_detail(run_id)["timeline"]]
+    assert stages == [
+        "graph_prep", "upload_refs", "submit", "poll", "queue_wait", "execute", "download", "archive",
+    ]
+    lines = (tmp_path / "traces" / f"{run_id}.jsonl").read_text().splitlines()
+    assert [json.loads(line)["stage"] for line in lines] == stages
+
+
+def test_zip_meta_includes_finalize_spans(orch, monkeypatch):
+    monkeypatch.setattr(orch, "_http", _comfy_client)
+    run_id = orch.create_run({"prompt": "x"})["run_id"]
+    orch.kickoff_generation(run_id, {"prompt": "x"})
+    orch.finalize_run(run_id)
+    with zipfile.ZipFile(orch.os.path.join(orch.RUNS_DIR, f"{run_id}.zip")) as zf:
+        zipped = json.loads(zf.read("meta.json"))
+    stages = [sp["stage"] for sp in zipped["timeline"]]
+    assert "download" in stages and "execute" in stages and "archive" not in stages
+
+
+def test_list_runs_duration_from_timeline(orch, monkeypatch):
+    monkeypatch.setattr(orch, "_http", _comfy_client)
+    run_id = orch.create_run({"prompt": "x"})["run_id"]
+    orch.kickoff_generation(run_id, {"prompt": "x"})
+    orch.finalize_run(run_id)
+    (run,) = orch.list_runs()
+    assert run["duration"] == round(orch.get_run_timeline(run_id)["elapsed_ms"] / 1000, 3)
+
+
+def test_list_runs_duration_falls_back_to_timestamps(orch):
+    run_id = orch.create_run({"prompt": "x"})["run_id"]
+    orch._update_run_status(run_id, "COMPLETED")
+    (run,) = orch.list_runs()
+    assert isinstance(run["duration"], int)
+
+
+def test_timeline_endpoint_rejects_unknown_format(orch):
+    run_id = orch.create_run({"prompt": "x"})["run_id"]
+    assert client.get(f"/runs/{run_id}/timeline", params={"format": "ndjson"}).status_code == 422
+
+
+def test_upload_metrics_endpoint(orch):
+    response = client.get("/metrics/uploads")
+    assert response.status_code == 200
+    assert response.json() == {"hits": 0, "misses": 0, "hit_rate": None, "cached": 0}
+
+
+def test_timeline_endpoint_unknown_run(orch):
+    assert client.get("/runs/nope/timeline").status_code == 404
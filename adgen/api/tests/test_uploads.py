@@ -0,0 +1,115 @@
+import httpx
+import pytest
+
+
+def _comfy(calls, stored):
+    """Minimal ComfyUI stand-in for /upload/image and HEAD /view."""
+    def handler(req: httpx.Request) -> httpx.Response:
+        calls.append((req.method, req.url.path))
+        if req.url.path == "/upload/image":
+            name = req.content.split(b'filename="', 1)[1].split(b'"', 1)[0].decode()
+            stored.add(name)
+            return httpx.Response(200, json={"name": name, "subfolder": "", "type": "input"})
+        if req.method == "HEAD" and req.url.path == "/view":
+            return httpx.Response(200 if req.url.params["filename"] in stored else 404)
+        return httpx.Response(404)
+    return httpx.Client(transport=httpx.MockTransport(handler), base_url="http://comfy")
+
+
+def _asset(orch, rel, data=b"png-bytes"):
+    p = orch.Path(orch.ASSETS_DIR) / rel
+    p.parent.mkdir(parents=True, exist_ok=True)
+    p.write_bytes(data)
+    return p
+
+
+def test_reference_paths_from_body(orch):
+    assert orch._reference_paths({"logo_image": "logos/a.png", "mood_image": "mood/b.jpg"}) == {
+        "logo": ["logos/a.png"], "mood": ["mood/b.jpg"],
+    }
+    assert orch._reference_paths({"logo_image": None}) == {"logo": [], "mood": []}
+
+
+def test_reference_paths_skip_urls(orch):
+    refs = orch._reference_paths({"logo_image": "https://example.com/l.png", "mood_image": "http://x/m.jpg"})
+    assert refs == {"logo": [], "mood": []}
+
+
+def test_resolve_asset_inside_assets_dir(orch):
+    p = _asset(orch, "logos/a.png")
+    assert orch._resolve_asset("logos/a.png") == p.resolve()
+    assert orch._resolve_asset("assets/logos/a.png") == p.resolve()
+    with pytest.raises(FileNotFoundError):
+        orch._resolve_asset("logos/missing.png")
+
+
+@pytest.mark.parametrize("path", ["../secret.txt", "logos/../../secret.txt", "/etc/passwd"])
+def test_resolve_asset_rejects_paths_outside_assets_dir(orch, path):
+    (orch.Path(orch.ASSETS_DIR).parent / "secret.txt").write_text("nope")
+    with pytest.raises(ValueError):
+        orch._resolve_asset(path)
+
+
+def test_upload_is_deduplicated_by_content(orch):
+    _asset(orch, "logos/a.png")
+    _asset(orch, "logos/copy.png")  # same bytes, different file
+    calls, stored = [], set()
+    with _comfy(calls, stored) as client:
+        first = orch._upload_image(client, orch._resolve_asset("logos/a.png"))
+        second = orch._upload_image(client, orch._resolve_asset("logos/copy.png"))
+    assert first == second and first.startswith("adgen_")
+    assert calls.count(("POST", "/upload/image")) == 1
+    assert orch.upload_cache_stats() == {"hits": 1, "misses": 1, "hit_rate": 0.5, "cached": 1}
+
+
+def test_upload_stats_empty(orch):
+    assert orch.upload_cache_stats()["hit_rate"] is None
+
+
+def test_stale_cache_entry_is_reuploaded(orch):
+    path = _asset(orch, "logos/a.png")
+    calls, stored = [], set()
+    with _comfy(calls, stored) as client:
+        orch._upload_image(client, path)
+        stored.clear()  # ComfyUI input/ wiped
+        orch._upload_image(client, path)
+    assert calls.count(("POST", "/upload/image")) == 2
+    assert orch.upload_cache_stats()["misses"] == 2
+
+
+def _graph(*titles):
+    graph = {str(i): {"class_type": "LoadImage", "_meta": {"title": t}, "inputs": {}} for i, t in enumerate(titles)}
+    graph["save"] = {"class_type": "SaveImage", "inputs": {}}
+    return graph
+
+
+def test_upload_references_and_graph_wiring(orch):
+    _asset(orch, "logos/a.png", b"logo")
+    _asset(orch, "mood/1.jpg", b"mood1")
+    graph = _graph("Brand Logo", "Mood board", "Product shot")
+    graph["2"]["inputs"]["image"] = "keep.png"
+    with _comfy([], set()) as client:
+        refs = orch._upload_references(client, {"logo_image": "logos/a.png", "mood_image": "assets/mood/1.jpg"}, graph)
+    orch._wire_reference_images(graph, refs)
+    assert graph["0"]["inputs"]["image"] == refs["logo"][0]
+    assert graph["1"]["inputs"]["image"] == refs["mood"][0]
+    assert graph["2"]["inputs"]["image"] == "keep.png"
+    assert "image" not in graph["save"]["inputs"]
+
+
+def test_references_without_slot_are_not_uploaded(orch):
+    calls = []
+    graph = _graph("Brand Logo")
+    with _comfy(calls, set()) as client:
+        # the mood file doesn't exist, but the graph has no mood slot so it is never resolved
+        refs = orch._upload_references(client, {"mood_image": "mood/missing.jpg"}, graph)
+    assert refs == {"logo": [], "mood": []}
+    assert calls == []
+
+
+def test_kickoff_ignores_references_the_graph_cannot_use(orch, monkeypatch):
+    # The shipped qwen.json has no LoadImage node
+    monkeypatch.setattr(orch, "TEST_MODE", True)
+    run_id = orch.create_run({"prompt": "x"})["run_id"]
+    result = orch.kickoff_generation(run_id, {"prompt": "x", "logo_image": "logos/nope.png"})
+    assert result["status"] == "RUNNING"